@@ -1,10 +1,21 @@
 import os
 import configparser
+import json
+import tempfile
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
 from plexapi.server import PlexServer
 from plexapi.myplex import MyPlexAccount
 from plexapi.library import LibrarySection
-from datetime import datetime, timedelta
+from plexapi.collection import Collection
+from plexapi.base import PlexObject
+from datetime import date, datetime, timedelta
 from ast import literal_eval
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections.abc import Callable, Iterator
 import logging
 
 logging.basicConfig(
@@ -13,6 +24,18 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Number of items requested per page when searching a library section
+SEARCH_CONTAINER_SIZE = 500
+
+
+@dataclass(slots=True, frozen=True)
+class SectionCfg:
+    """The parsed settings of a single library section."""
+
+    stale_days: int
+    keep_watchlisted: bool
+    keep_collections: tuple[str, ...]
+
 
 class ContentRemover(object):
     def __init__(self, config_path: str = "./config.yaml") -> None:
@@ -29,149 +52,345 @@ class ContentRemover(object):
         self._config.read(self._config_path)
 
         self._dry_run = self._config.getboolean("DEFAULT", "dry_run")
+        self._parallel = self._config.getboolean("DEFAULT", "parallel", fallback=True)
+
+        # Share one pooled keep-alive session between all the (threaded) requests
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=3)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
 
         # Get the server
         self._server = PlexServer(
             baseurl=self._config.get("auth", "server_url"),
             token=self._config.get("auth", "token"),
+            session=session,
         )
         self._account: MyPlexAccount = self._server.myPlexAccount()
 
         # Check if the server is reachable
         if not self._account.ping():
-            logging.error("Plex server is not reachable")
+            logger.error("Plex server is not reachable")
             raise ConnectionError("Plex server is not reachable")
 
-        logging.debug("Plex server is reachable")
+        logger.debug("Plex server is reachable")
+
+        # The watchlist changes slowly, keep it between runs next to the config file
+        self._cache_ttl = self._config.getint("DEFAULT", "cache_ttl", fallback=0)
+        self._cache_path = os.path.join(
+            os.path.dirname(os.path.abspath(self._config_path)),
+            f".content_remover_{self._server.machineIdentifier}.cache.json",
+        )
+        self._cache_lock = threading.Lock()
+        self._cache: dict[str, list] = self._load_cache()
 
         # Get all the library sections
         self._library_sections_to_search = self._config.sections()
         self._library_sections_to_search.remove("auth")
 
+        # List all the library sections in a single request and keep them for later use,
+        # titles are matched case-insensitively like plexapi's library.section()
+        self._section_cache: dict[str, LibrarySection] = {
+            self._title_key(lib_section.title): lib_section
+            for lib_section in self._server.library.sections()
+        }
+
         # Check if the library sections exist
         for section in self._library_sections_to_search:
-            if not self._server.library.section(section):
-                logging.error(f"Library section {section} not found")
+            if self._title_key(section) not in self._section_cache:
+                logger.error("Library section %s not found", section)
                 raise ValueError(f"Library section {section} not found")
+
+        # Parse the library section settings once
+        self._section_cfg: dict[str, SectionCfg] = {
+            section: self._parse_section_cfg(section)
+            for section in self._library_sections_to_search
+        }
         return
 
     # Methods
-    def get_stale_content(self, filtered: bool = True) -> dict[str, list[str]]:
-        stale_content = {}
-        for section in self._library_sections_to_search:
-            stale_content[section] = self._get_stale_content(section, filtered=filtered)
-
-        if logger.isEnabledFor(logging.DEBUG):
-            for section, stale_items in stale_content.items():
-                logging.debug(
-                    f"Found {len(stale_items)} stale items in {section}: {[item.title for item in stale_items]}"
-                )
-        return stale_content
+    def get_stale_content(
+        self, filtered: bool = True
+    ) -> Iterator[tuple[str, PlexObject]]:
+        """Yield (library section, item) pairs of stale content as they are found."""
+        for section, stale_items in self._iter_stale(filtered=filtered):
+            for item in stale_items:
+                yield section, item
+
+    def get_stale_content_dict(self, filtered: bool = True) -> dict[str, list]:
+        """Return the stale content of all the library sections at once."""
+        return {
+            section: list(stale_items)
+            for section, stale_items in self._iter_stale(filtered=filtered)
+        }
 
     def clean_stale_content(self) -> None:
         stale_content = self.get_stale_content()
 
         if self._dry_run:
-            logging.warning("Dry run enabled, no content will be removed")
-            if logger.isEnabledFor(logging.INFO):
-                for section, stale_items in stale_content.items():
-                    logging.info(
-                        f"Found {len(stale_items)} stale items in {section}: {[item.title for item in stale_items]}"
-                    )
+            logger.warning("Dry run enabled, no content will be removed")
+            counts = dict.fromkeys(self._library_sections_to_search, 0)
+            for section, item in stale_content:
+                counts[section] += 1
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Found stale item in %s: %s", section, item.title)
+            for section, count in counts.items():
+                logger.info("Found %d stale items in %s", count, section)
             return
 
     # Support functions
-    def _get_stale_content(self, library_name: str, filtered: bool = True) -> list[str]:
+    def _iter_stale(self, filtered: bool = True) -> Iterator[tuple[str, list]]:
+        """Yield the stale content of each library section as soon as it is fetched."""
+        # Use the same reference date for all the libraries in this run
+        run_start = datetime.now().date()
+
+        sections = self._library_sections_to_search
+
+        # The watchlist is account wide, so fetch it once for all the libraries
+        watchlist: list[str] = []
+        if filtered and any(self._section_cfg[s].keep_watchlisted for s in sections):
+            watchlist = self._get_watchlist(user=self._account)
+
+        if self._parallel and len(sections) > 1:
+            # The lookups are I/O bound so fetch the libraries concurrently
+            with ThreadPoolExecutor(max_workers=min(8, len(sections))) as executor:
+                futures = {
+                    executor.submit(
+                        self._get_stale_content,
+                        section,
+                        run_start,
+                        watchlist,
+                        filtered=filtered,
+                    ): section
+                    for section in sections
+                }
+                for future in as_completed(futures):
+                    yield self._log_stale(futures[future], future.result())
+        else:
+            for section in sections:
+                yield self._log_stale(
+                    section,
+                    self._get_stale_content(
+                        section, run_start, watchlist, filtered=filtered
+                    ),
+                )
+
+    def _log_stale(self, section: str, stale_items: list) -> tuple[str, list]:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Found %d stale items in %s: %s",
+                len(stale_items),
+                section,
+                [item.title for item in stale_items],
+            )
+        return section, stale_items
+
+    def _get_stale_content(
+        self,
+        library_name: str,
+        run_start: date,
+        watchlist: list[str],
+        filtered: bool = True,
+    ) -> list[str]:
         """Return a list of stale content ids.
 
         Content is considered stale is it exceeds the number of days since adding
         and is not watchlisted or favorited by any users.
         """
         # Get the library section and stale content
-        lib_section: LibrarySection = self._server.library.section(library_name)
-        thresh_date = datetime.now().date() - timedelta(
-            days=self._config.getint(library_name, "stale_days")
-        )
-        stale_content = lib_section.search(
-            filters={"addedAt<<": thresh_date.strftime("%Y-%m-%d")}
-        )
-        # Filter out watchlisted or favorited content if configured to do so
-        if self._config.getboolean(library_name, "keep_watchlisted") and filtered:
-            stale_content = self._remove_watchlisted(
-                user=self._account,
-                stale_content=stale_content,
-                lib_section=lib_section,
+        cfg = self._section_cfg[library_name]
+        lib_section = self._get_section(library_name)
+        thresh_date = run_start - timedelta(days=cfg.stale_days)
+        filters = [{"addedAt<<": thresh_date.isoformat()}]
+
+        kept_colls: list[Collection] = []
+        if len(cfg.keep_collections) > 0 and filtered:
+            kept_colls = self._get_collections(
+                collections=cfg.keep_collections, lib_section=lib_section
             )
 
-        # Filter out content in collections if configured to do so
-        keep_collections = literal_eval(
-            self._config.get(library_name, "keep_collections")
+        # Let the server exclude content in regular collections, passing the
+        # rating key as is so plexapi doesn't query the filter choices again
+        filters.extend(
+            {"collection!": coll.ratingKey} for coll in kept_colls if not coll.smart
         )
-        if len(keep_collections) > 0 and filtered:
-            stale_content = self._remove_collections(
-                stale_content=stale_content,
-                collections=keep_collections,
-                lib_section=lib_section,
-            )
-
-        return stale_content
 
-    def _remove_watchlisted(
-        self, user: MyPlexAccount, stale_content: list, lib_section: LibrarySection
-    ) -> list:
-        # Get the watchlisted content
-        watchlist = user.watchlist()
+        # Fetch larger pages than the plexapi default to save round-trips
+        stale_content = lib_section.search(
+            filters={"and": filters}, container_size=SEARCH_CONTAINER_SIZE
+        )
 
-        logging.debug(f"Found {len(watchlist)} items in the watchlist")
+        # Collect the content that should be kept despite being stale
+        excl_keys: set[int] = set()
 
-        for item in watchlist:
-            result = lib_section.search(guid=item.guid)
-            if len(result) == 0:
-                # Movie is watchlisted but not in the library
-                continue
+        # Smart collections don't tag their members, so exclude them client-side
+        for coll in kept_colls:
+            if coll.smart:
+                excl_keys.update(item.ratingKey for item in coll.items())
 
-            logging.debug(f"Found watchlisted item {item.title} on server")
+        if cfg.keep_watchlisted and filtered:
+            excl_keys |= self._get_watchlisted_keys(
+                watchlist=watchlist,
+                stale_content=stale_content,
+            )
 
-            for res in result:
-                if res in stale_content:
-                    logging.debug(
-                        f"Removing watchlisted item {res.title} from stale list"
-                    )
-                    stale_content.remove(res)
+        # Filter out all the kept content in a single pass
+        if excl_keys:
+            stale_content = [
+                item for item in stale_content if item.ratingKey not in excl_keys
+            ]
 
         return stale_content
 
-    def _remove_collections(
-        self, stale_content: list, collections: list[int], lib_section: LibrarySection
-    ) -> list:
-        logging.debug(f"Checking {len(collections)} collections to keep")
+    def _get_section(self, library_name: str) -> LibrarySection:
+        """Return the library section listed at startup."""
+        return self._section_cache[self._title_key(library_name)]
+
+    @staticmethod
+    def _title_key(title: str) -> str:
+        """Return the key a Plex title is matched on, ignoring case like plexapi."""
+        return title.lower().strip()
+
+    def _parse_section_cfg(self, library_name: str) -> SectionCfg:
+        """Read the settings of a library section from the config file."""
+        return SectionCfg(
+            stale_days=self._config.getint(library_name, "stale_days"),
+            keep_watchlisted=self._config.getboolean(library_name, "keep_watchlisted"),
+            keep_collections=self._parse_list(
+                self._config.get(library_name, "keep_collections", fallback="")
+            ),
+        )
+
+    @staticmethod
+    def _parse_list(value: str) -> tuple[str, ...]:
+        """Parse a comma-separated config value into a tuple of strings."""
+        if value.strip().startswith("["):
+            # Support the older Python list notation, e.g. ['a', 'b']
+            return tuple(str(v) for v in literal_eval(value))
+        return tuple(v.strip() for v in value.split(",") if v.strip())
+
+    def _load_cache(self) -> dict[str, list]:
+        """Load the cache of previous runs, starting empty if it is unusable."""
+        if self._cache_ttl <= 0 or not os.path.isfile(self._cache_path):
+            return {}
+        try:
+            with open(self._cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable cache %s: %s", self._cache_path, e)
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def _cached(self, name: str, fetch: Callable[[], list[str]]) -> list[str]:
+        """Return the cached strings for name, refetching them after the TTL."""
+        if self._cache_ttl <= 0:
+            return fetch()
+
+        with self._cache_lock:
+            entry = self._cache.get(name)
+        if (
+            isinstance(entry, list)
+            and len(entry) == 2
+            and isinstance(entry[0], (int, float))
+            and isinstance(entry[1], list)
+            and all(isinstance(value, str) for value in entry[1])
+            and time.time() - entry[0] < self._cache_ttl
+        ):
+            logger.debug("Using cached %s", name)
+            return entry[1]
+
+        value = fetch()
+        with self._cache_lock:
+            self._cache[name] = [time.time(), value]
+            # Write to a new temporary file first so a crash never leaves a partial
+            # cache, and remove it again if anything goes wrong
+            tmp_path = None
+            try:
+                with tempfile.NamedTemporaryFile(
+                    "w",
+                    dir=os.path.dirname(self._cache_path),
+                    suffix=".tmp",
+                    delete=False,
+                    encoding="utf-8",
+                ) as f:
+                    tmp_path = f.name
+                    json.dump(self._cache, f)
+                os.replace(tmp_path, self._cache_path)
+            except (OSError, TypeError, ValueError) as e:
+                logger.warning("Could not write cache %s: %s", self._cache_path, e)
+                if tmp_path is not None:
+                    try:
+                        os.unlink(tmp_path)
+                    except OSError:
+                        pass
+        return value
+
+    def _get_watchlist(self, user: MyPlexAccount) -> list[str]:
+        """Return the guids of the watchlisted content."""
+        watchlist = self._cached(
+            "watchlist", lambda: [item.guid for item in user.watchlist()]
+        )
+        logger.debug("Found %d items in the watchlist", len(watchlist))
+        return watchlist
+
+    def _get_watchlisted_keys(
+        self, watchlist: list[str], stale_content: list
+    ) -> set[int]:
+        """Return the rating keys of the stale content that is watchlisted."""
+        if not stale_content:
+            return set()
+
+        # The stale content was already fetched from this library, so index it
+        # by guid instead of searching the server for every watchlist entry
+        guid_index: dict[str, list[PlexObject]] = {}
+        for item in stale_content:
+            guid_index.setdefault(item.guid, []).append(item)
+
+        keys: set[int] = set()
+        for guid in watchlist:
+            if not guid_index:
+                # Everything stale is watchlisted, no need to check the rest
+                break
+
+            # Item may be watchlisted but not stale or not in the library
+            for res in guid_index.pop(guid, ()):
+                keys.add(res.ratingKey)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "Removing watchlisted item %s from stale list", res.title
+                    )
 
-        in_collections = (
-            []
-        )  # the collection items that are actually in these collections
+        return keys
+
+    def _get_collections(
+        self, collections: tuple[str, ...], lib_section: LibrarySection
+    ) -> list[Collection]:
+        """Return the given collections of the library."""
+        logger.debug("Checking %d collections to keep", len(collections))
+
+        # Fetch all the collections of the library in a single request
+        all_colls: dict[str, Collection] = {}
+        for coll in lib_section.collections():
+            key = self._title_key(coll.title)
+            if key in all_colls:
+                logger.warning(
+                    "Multiple collections named %s in %s, using the last one",
+                    coll.title,
+                    lib_section.title,
+                )
+            all_colls[key] = coll
 
+        kept_colls = []
         for collection in collections:
             # Get the collection
-            coll = lib_section.collection(title=collection)
-            if not coll:
+            coll = all_colls.get(self._title_key(collection))
+            if coll is None:
                 # Raise an error to prevent accidental deletions
-                logging.error(f"Collection {collection} not found")
+                logger.error("Collection %s not found", collection)
                 raise ValueError(f"Collection {collection} not found")
+            kept_colls.append(coll)
 
-            # Add the items in the collection to the list
-            for item in coll.items():
-                # Only add if its not in the collections summary already
-                if item not in in_collections:
-                    in_collections.append(item)
-
-        # Remove the collection items from the stale content
-        filtered = []
-        for item in stale_content:
-            if item not in in_collections:
-                filtered.append(item)
-                logging.debug(f"Removing item {item.title} from stale list")
-
-        return filtered
+        return kept_colls
 
 
 if __name__ == "__main__":